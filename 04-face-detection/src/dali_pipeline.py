@@ -0,0 +1,168 @@
+import io
+import math
+import pathlib
+import random
+from typing import List, Dict
+
+import numpy as np
+import torch
+import nvidia.dali.fn as fn
+import nvidia.dali.types as types
+from nvidia.dali import pipeline_def
+from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+from PIL import Image
+from skimage.color import rgba2rgb
+from skimage.io import imread
+
+from src.transformations import map_class_to_int
+from src.utils import read_json
+
+
+class FaceExternalSource:
+    """
+    Feeds a DALI pipeline with encoded images, boxes, labels and sample indices.
+    Encoded images are kept in RAM (like use_cache=True of FaceDataset).
+    Boxes are returned relative to the image size (xyxy, [0, 1]) and clipped (replaces Clip()).
+    """
+
+    def __init__(self,
+                 inputs: List[pathlib.Path],
+                 targets: List[pathlib.Path],
+                 batch_size: int,
+                 mapping: Dict = None,
+                 shuffle: bool = True
+                 ):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.samples = [self.read_sample(inp, tar, mapping) for inp, tar in zip(inputs, targets)]
+
+    @staticmethod
+    def read_sample(inp, tar, mapping):
+        image = imread(inp)
+        height, width = image.shape[:2]
+        if image.shape[-1] == 4:
+            # From RGBA to RGB like FaceDataset (blended onto white), the decoder would just drop alpha
+            rgb = (rgba2rgb(image) * 255).round().astype(np.uint8)
+            buffer = io.BytesIO()
+            Image.fromarray(rgb).save(buffer, format='PNG')
+            encoded = np.frombuffer(buffer.getvalue(), dtype=np.uint8)
+        else:
+            encoded = np.fromfile(str(inp), dtype=np.uint8)
+
+        y = read_json(tar)
+        boxes = np.asarray(y['boxes'], dtype=np.float32).reshape(-1, 4)
+        boxes = np.clip(boxes / np.array([width, height, width, height], dtype=np.float32), 0.0, 1.0)
+        labels = map_class_to_int(y['labels'], mapping=mapping) if mapping else np.asarray(y['labels'])
+
+        return encoded, boxes, labels.astype(np.int32)
+
+    def __iter__(self):
+        self.order = list(range(len(self.samples)))
+        if self.shuffle:
+            random.shuffle(self.order)
+        self.position = 0
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.order):
+            raise StopIteration
+
+        batch = self.order[self.position:self.position + self.batch_size]
+        self.position += self.batch_size
+
+        encoded, boxes, labels = zip(*[self.samples[i] for i in batch])
+        indices = [np.array([i], dtype=np.int32) for i in batch]
+        return list(encoded), list(boxes), list(labels), indices
+
+    def __len__(self):
+        return math.ceil(len(self.samples) / self.batch_size)
+
+
+@pipeline_def
+def face_train_pipeline(source):
+    jpegs, boxes, labels, indices = fn.external_source(
+        source=source, num_outputs=4, dtype=[types.UINT8, types.FLOAT, types.INT32, types.INT32])
+    images = fn.decoders.image(jpegs, device='mixed', output_type=types.RGB)
+
+    # HorizontalFlip(p=0.5)
+    flip = fn.random.coin_flip(probability=0.5)
+    boxes = fn.bb_flip(boxes, ltrb=True, horizontal=flip)
+
+    # RandomScale(p=0.5, scale_limit=0.5), relative boxes are not affected
+    scale = fn.random.coin_flip(probability=0.5) * (fn.random.uniform(range=[0.5, 1.5]) - 1.0) + 1.0
+    shape = fn.peek_image_shape(jpegs, dtype=types.FLOAT)  # H W C
+    images = fn.resize(images, resize_x=shape[1] * scale, resize_y=shape[0] * scale)
+
+    # HWC uint8 -> CHW float, rescaled per image with normalize_01 in DALIFaceLoader
+    images = fn.crop_mirror_normalize(images,
+                                      mirror=flip,
+                                      mean=[0.0, 0.0, 0.0],
+                                      std=[255.0, 255.0, 255.0],
+                                      output_layout='CHW',
+                                      dtype=types.FLOAT)
+    sizes = fn.shapes(images)  # C H W before padding
+
+    # the iterator needs dense batches
+    images = fn.pad(images, axes=(1, 2))
+    boxes = fn.pad(boxes, fill_value=-1.0)
+    labels = fn.pad(labels, fill_value=-1)
+
+    return images, sizes, boxes, labels, indices
+
+
+class DALIFaceLoader:
+    """
+    Training loader for FaceDataset inputs/targets: decoding and augmentation run in a DALI pipeline on the GPU.
+    Returns batches in the collate_double format: x, y, x_name, y_name
+    """
+
+    def __init__(self,
+                 inputs: List[pathlib.Path],
+                 targets: List[pathlib.Path],
+                 batch_size: int,
+                 mapping: Dict = None,
+                 num_threads: int = 4,
+                 device_id: int = 0,
+                 seed: int = 42
+                 ):
+        self.inputs = inputs
+        self.targets = targets
+        self.source = FaceExternalSource(inputs, targets, batch_size, mapping=mapping)
+
+        pipe = face_train_pipeline(source=self.source,
+                                   batch_size=batch_size,
+                                   num_threads=num_threads,
+                                   device_id=device_id,
+                                   seed=seed)
+        pipe.build()
+        self.iterator = DALIGenericIterator(pipe,
+                                            ['x', 'sizes', 'boxes', 'labels', 'index'],
+                                            last_batch_policy=LastBatchPolicy.PARTIAL,
+                                            auto_reset=True)
+
+    def __len__(self):
+        return len(self.source)
+
+    def __iter__(self):
+        for data in self.iterator:
+            data = data[0]
+            x, y, x_name, y_name = [], [], [], []
+            # sizes is produced on the GPU, copy it to the host once per batch instead of once per image
+            sizes = data['sizes'].cpu().tolist()
+            for image, size, boxes, labels, index in zip(data['x'], sizes, data['boxes'],
+                                                         data['labels'], data['index']):
+                _, height, width = size
+                valid = labels >= 0
+                scale = torch.tensor([width, height, width, height], dtype=torch.float32, device=boxes.device)
+
+                # normalize_01, same as the pre_transforms of the validation/test FaceDataset
+                image = image[:, :height, :width]
+                low = image.min()
+                x.append((image - low) / (image.max() - low))
+                y.append({'boxes': boxes[valid] * scale, 'labels': labels[valid].to(torch.int64)})
+
+                i = int(index[0])
+                x_name.append(self.inputs[i].name)
+                y_name.append(self.targets[i].name)
+
+            yield x, y, x_name, y_name
@@ -20,6 +20,9 @@ class FaceDataset(torch.utils.data.Dataset):
     inputs and targets are expected to be a list of pathlib.Path objects.
 
     In case your labels are strings, you can use mapping (a dict) to int-encode them.
+    Deterministic transforms (e.g. Clip, normalize_01) can be passed as pre_transform:
+    with use_cache=True they are applied once and the cache stores their output,
+    transform is applied on every __getitem__.
     Returns a dict with the following keys: 'x', 'x_name', 'y', 'y_name'
     """
 
@@ -29,7 +32,8 @@ class FaceDataset(torch.utils.data.Dataset):
                  transform: ComposeDouble = None,
                  use_cache: bool = False,
                  convert_to_format: str = None,
-                 mapping: Dict = None
+                 mapping: Dict = None,
+                 pre_transform: ComposeDouble = None
                  ):
         self.inputs = inputs
         self.targets = targets
@@ -37,11 +41,13 @@ class FaceDataset(torch.utils.data.Dataset):
         self.use_cache = use_cache
         self.convert_to_format = convert_to_format
         self.mapping = mapping
+        self.pre_transform = pre_transform
 
         if self.use_cache:
             # Use multiprocessing to load images and targets into RAM
             with Pool() as pool:
-                self.cached_data = pool.starmap(self.read_images, zip(inputs, targets))
+                cached_data = pool.starmap(self.read_images, zip(inputs, targets))
+            self.cached_data = [self.prepare(x, y) for x, y in cached_data]
 
     def __len__(self):
         return len(self.inputs)
@@ -49,15 +55,27 @@ class FaceDataset(torch.utils.data.Dataset):
     def __getitem__(self,
                     index: int):
         if self.use_cache:
-            x, y = self.cached_data[index]
+            x, target = self.cached_data[index]
+            target = dict(target)  # transforms replace the values, keep the cached dict untouched
         else:
             # Select the sample
             input_ID = self.inputs[index]
             target_ID = self.targets[index]
 
             # Load input and target
-            x, y = self.read_images(input_ID, target_ID)
+            x, target = self.prepare(*self.read_images(input_ID, target_ID))
 
+        if self.transform is not None:
+            x, target = self.transform(x, target)  # returns np.ndarrays
+
+        # Typecasting
+        x = torch.from_numpy(x).type(torch.float32)
+        target = {key: torch.from_numpy(value).type(torch.int64) for key, value in target.items()}
+
+        return {'x': x, 'y': target, 'x_name': self.inputs[index].name, 'y_name': self.targets[index].name}
+
+    def prepare(self, x, y):
+        """Converts a raw input-target pair to np.ndarrays and applies pre_transform."""
         # From RGBA to RGB
         if x.shape[-1] == 4:
             x = rgba2rgb(x)
@@ -103,14 +121,10 @@ class FaceDataset(torch.utils.data.Dataset):
         # Preprocessing
         target = {key: value.numpy() for key, value in target.items()}  # all tensors should be converted to np.ndarrays
 
-        if self.transform is not None:
-            x, target = self.transform(x, target)  # returns np.ndarrays
-
-        # Typecasting
-        x = torch.from_numpy(x).type(torch.float32)
-        target = {key: torch.from_numpy(value).type(torch.int64) for key, value in target.items()}
+        if self.pre_transform is not None:
+            x, target = self.pre_transform(x, target)  # returns np.ndarrays
 
-        return {'x': x, 'y': target, 'x_name': self.inputs[index].name, 'y_name': self.targets[index].name}
+        return x, target
 
     @staticmethod
     def read_images(inp, tar):
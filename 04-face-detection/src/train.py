@@ -4,6 +4,7 @@ import pathlib
 
 import albumentations as A
 import numpy as np
+import torch
 
 from pytorch_lightning import Trainer
 from pytorch_lightning.loggers import CSVLogger
@@ -26,7 +27,7 @@ params = {'BATCH_SIZE': 8,
           'LOG_MODEL': False,  # whether to log the model to neptune after training
           'GPU': 0,  # set to None for cpu training
           'LR': 0.001,
-          'PRECISION': 32,
+          'PRECISION': 16,  # native AMP
           'CLASSES': 2,
           'SEED': 42,
           'PROJECT': 'Heads',
@@ -41,7 +42,10 @@ params = {'BATCH_SIZE': 8,
           'MAX_SIZE': 1024,
           'IMG_MEAN': [0.485, 0.456, 0.406],
           'IMG_STD': [0.229, 0.224, 0.225],
-          'IOU_THRESHOLD': 0.5
+          'IOU_THRESHOLD': 0.5,
+          'NUM_WORKERS': max(1, os.cpu_count() // 2),  # dataloader training workers
+          'NUM_WORKERS_EVAL': 2,  # dataloader validation/test workers
+          'DALI': False,  # training data via the DALI GPU pipeline (requires nvidia-dali and a GPU)
           }
 
 
@@ -68,28 +72,29 @@ def main():
         'head': 1,
     }
 
+    # deterministic transformations, applied once when the datasets are cached
+    pre_transforms = ComposeDouble([
+        Clip(),
+        FunctionWrapperDouble(normalize_01),
+        FunctionWrapperDouble(np.asarray, dtype=np.float32)  # float64 -> float32, halves the cached RAM
+    ])
+
     # training transformations and augmentations
     transforms_training = ComposeDouble([
-        Clip(),
         AlbumentationWrapper(albumentation=A.HorizontalFlip(p=0.5)),
         AlbumentationWrapper(albumentation=A.RandomScale(p=0.5, scale_limit=0.5)),
         # AlbuWrapper(albu=A.VerticalFlip(p=0.5)),
-        FunctionWrapperDouble(np.moveaxis, source=-1, destination=0),
-        FunctionWrapperDouble(normalize_01)
+        FunctionWrapperDouble(np.moveaxis, source=-1, destination=0)
     ])
 
     # validation transformations
     transforms_validation = ComposeDouble([
-        Clip(),
-        FunctionWrapperDouble(np.moveaxis, source=-1, destination=0),
-        FunctionWrapperDouble(normalize_01)
+        FunctionWrapperDouble(np.moveaxis, source=-1, destination=0)
     ])
 
     # test transformations
     transforms_test = ComposeDouble([
-        Clip(),
-        FunctionWrapperDouble(np.moveaxis, source=-1, destination=0),
-        FunctionWrapperDouble(normalize_01)
+        FunctionWrapperDouble(np.moveaxis, source=-1, destination=0)
     ])
 
     # random seed
@@ -99,18 +104,20 @@ def main():
     inputs_train, inputs_valid, inputs_test = inputs[:12], inputs[12:16], inputs[16:]
     targets_train, targets_valid, targets_test = targets[:12], targets[12:16], targets[16:]
 
-    # dataset training
-    dataset_train = FaceDataset(inputs=inputs_train,
-                                targets=targets_train,
-                                transform=transforms_training,
-                                use_cache=True,
-                                convert_to_format=None,
-                                mapping=mapping)
+    # dataset training (not used with DALI)
+    dataset_train = None if params['DALI'] else FaceDataset(inputs=inputs_train,
+                                                            targets=targets_train,
+                                                            transform=transforms_training,
+                                                            pre_transform=pre_transforms,
+                                                            use_cache=True,
+                                                            convert_to_format=None,
+                                                            mapping=mapping)
 
     # dataset validation
     dataset_valid = FaceDataset(inputs=inputs_valid,
                                 targets=targets_valid,
                                 transform=transforms_validation,
+                                pre_transform=pre_transforms,
                                 use_cache=True,
                                 convert_to_format=None,
                                 mapping=mapping)
@@ -119,29 +126,48 @@ def main():
     dataset_test = FaceDataset(inputs=inputs_test,
                                targets=targets_test,
                                transform=transforms_test,
+                               pre_transform=pre_transforms,
                                use_cache=True,
                                convert_to_format=None,
                                mapping=mapping)
 
     # dataloader training
-    dataloader_train = DataLoader(dataset=dataset_train,
-                                  batch_size=params['BATCH_SIZE'],
-                                  shuffle=True,
-                                  num_workers=0,
-                                  collate_fn=collate_double)
+    if params['DALI']:
+        # decoding and augmentation on the GPU, see src/dali_pipeline.py
+        if params['GPU'] is None:
+            raise ValueError("params['DALI'] requires a GPU, set params['GPU'] or disable DALI")
+        from src.dali_pipeline import DALIFaceLoader
+        dataloader_train = DALIFaceLoader(inputs=inputs_train,
+                                          targets=targets_train,
+                                          batch_size=params['BATCH_SIZE'],
+                                          mapping=mapping,
+                                          device_id=params['GPU'],
+                                          seed=params['SEED'])
+    else:
+        dataloader_train = DataLoader(dataset=dataset_train,
+                                      batch_size=params['BATCH_SIZE'],
+                                      shuffle=True,
+                                      num_workers=params['NUM_WORKERS'],
+                                      pin_memory=True,
+                                      persistent_workers=True,
+                                      prefetch_factor=4,
+                                      collate_fn=collate_double)
 
     # dataloader validation
     dataloader_valid = DataLoader(dataset=dataset_valid,
                                   batch_size=1,
                                   shuffle=False,
-                                  num_workers=0,
+                                  num_workers=params['NUM_WORKERS_EVAL'],
+                                  pin_memory=True,
+                                  persistent_workers=params['NUM_WORKERS_EVAL'] > 0,
                                   collate_fn=collate_double)
 
     # dataloader test
     dataloader_test = DataLoader(dataset=dataset_test,
                                  batch_size=1,
                                  shuffle=False,
-                                 num_workers=0,
+                                 num_workers=params['NUM_WORKERS_EVAL'],
+                                 pin_memory=True,
                                  collate_fn=collate_double)
 
     # model init
@@ -152,6 +178,8 @@ def main():
                                   fpn=params['FPN'],
                                   min_size=params['MIN_SIZE'],
                                   max_size=params['MAX_SIZE'])
+    # NHWC conv weights; conv outputs follow the weight format, so the batched input needs no conversion
+    model = model.to(memory_format=torch.channels_last)
     #model = torchvision.models.detection.ssd300_vgg16(num_classes=params['CLASSES'], pretrained_backbone=True)
 
     # lightning init
@@ -165,7 +193,8 @@ def main():
 
     # trainer init
     trainer = Trainer(gpus=1,
-                      precision=params['PRECISION'],  # try 16 with enable_pl_optimizer=False
+                      precision=params['PRECISION'],
+                      benchmark=True,  # cudnn.benchmark
                       callbacks=[checkpoint_callback, learningrate_callback, early_stopping_callback],
                       default_root_dir=save_dir,  # where checkpoints are saved to
                       log_every_n_steps=1,
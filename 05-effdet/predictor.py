@@ -39,13 +39,11 @@ def _postprocess_single_prediction_detections(detections, prediction_confidence_
     :return:
     """
 
-    boxes = detections.detach().cpu().numpy()[:, :4]
-    scores = detections.detach().cpu().numpy()[:, 4]
-    classes = detections.detach().cpu().numpy()[:, 5]
-    indexes = np.where(scores > prediction_confidence_threshold)[0]
-    boxes = boxes[indexes]
+    # threshold는 device에서 적용하고, 남은 row만 한번에 cpu로 복사
+    keep = detections[:, 4] > prediction_confidence_threshold
+    detections = detections[keep].detach().cpu().numpy()
 
-    return {"boxes": boxes, "scores": scores[indexes], "classes": classes[indexes]}
+    return {"boxes": detections[:, :4], "scores": detections[:, 4], "classes": detections[:, 5]}
 
 
 def post_process_detections(detections, img_size, wbf_iou_threshold, prediction_confidence_threshold):
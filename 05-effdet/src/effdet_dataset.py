@@ -45,3 +45,18 @@ class EfficientDetDataset(Dataset):
 
     def __len__(self):
         return len(self.ds)
+
+
+class PILDataset(Dataset):
+    """
+    predict(images: List)에서 사용. PIL image를 HWC uint8 tensor로 변환만 하고
+    resize/normalize는 GPU에서 batch로 수행한다.
+    """
+    def __init__(self, images):
+        self.images = images
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.array(self.images[index].convert("RGB"), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.images)
@@ -1,41 +1,73 @@
+import functools
+import queue
+import threading
+
+import kornia.augmentation as K
 import torch
 from pytorch_lightning import LightningModule
+from torch.utils.data import DataLoader
+from torchvision.ops import batched_nms
 
-from src.effdet_transformations import get_valid_transforms
+from src.effdet_dataset import PILDataset
+from src.effdet_transformations import IMG_MEAN, IMG_STD
 from src.effdet_create_model import create_model
+from effdet.bench import _post_process, _batch_detection
 
 from fastcore.dispatch import typedispatch
 from typing import List, Tuple
 import numpy as np
+from joblib import Parallel, delayed
 
 from ensemble_boxes import ensemble_boxes_wbf
 from objdetecteval.metrics.coco_metrics import get_coco_stats
 
 
-def run_wbf(predictions, image_size=512, iou_thr=0.44, skip_box_thr=0.43, weights=None):
-    bboxes = []
-    confidences = []
-    class_labels = []
+def _run_wbf_single(prediction, image_size, iou_thr, skip_box_thr, weights):
+    boxes, scores, labels = ensemble_boxes_wbf.weighted_boxes_fusion(
+        [prediction["boxes"] / image_size],
+        [prediction["scores"]],
+        [prediction["classes"]],
+        weights=weights,
+        iou_thr=iou_thr,
+        skip_box_thr=skip_box_thr,
+    )
+    return boxes * (image_size - 1), scores, labels
+
+
+def run_wbf(predictions, image_size=512, iou_thr=0.44, skip_box_thr=0.43, weights=None, n_jobs=1):
+    """
+    image 별로 weighted_boxes_fusion을 수행한다.
+    list를 거치지 않고 numpy array를 그대로 넘기고, image 별 numpy array를 반환한다.
+
+    :param n_jobs: joblib worker 수. 1이면 순차 실행
+    :return: bboxes, confidences, class_labels (image 별 numpy array의 list)
+    """
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_run_wbf_single)(prediction, image_size, iou_thr, skip_box_thr, weights)
+        for prediction in predictions
+    )
+    if len(results) == 0:
+        return [], [], []
+
+    bboxes, confidences, class_labels = (list(result) for result in zip(*results))
+    return bboxes, confidences, class_labels
 
-    for prediction in predictions:
-        boxes = [(prediction["boxes"] / image_size).tolist()]
-        scores = [prediction["scores"].tolist()]
-        labels = [prediction["classes"].tolist()]
 
-        boxes, scores, labels = ensemble_boxes_wbf.weighted_boxes_fusion(
-            boxes,
-            scores,
-            labels,
-            weights=weights,
-            iou_thr=iou_thr,
-            skip_box_thr=skip_box_thr,
-        )
-        boxes = boxes * (image_size - 1)
-        bboxes.append(boxes.tolist())
-        confidences.append(scores.tolist())
-        class_labels.append(labels.tolist())
-
-    return bboxes, confidences, class_labels
+@functools.lru_cache(maxsize=16)
+def _dummy_inference_targets(num_images, img_size, device):
+    """
+    inference용 dummy target. (num_images, img_size, device) 별로 한번만 만들고 재사용한다.
+    DetBenchTrain은 target을 읽기만 하므로 공유해도 된다.
+    """
+    bbox = torch.zeros((num_images, 1, 4), device=device)
+    cls = torch.ones((num_images, 1), device=device)
+    return {
+        # DetBenchTrain은 image 별 tensor의 list를 받는다
+        "bbox": list(bbox.unbind(0)),
+        "cls": list(cls.unbind(0)),
+        "img_size": torch.tensor([img_size, img_size], device=device).float().expand(num_images, 2),
+        "img_scale": torch.ones(1, device=device).expand(num_images),
+    }
 
 
 class EfficientDetModel(LightningModule):
@@ -46,7 +78,9 @@ class EfficientDetModel(LightningModule):
             prediction_confidence_threshold=0.2,
             learning_rate=0.0002,
             wbf_iou_threshold=0.44,
-            inference_transforms=get_valid_transforms(target_img_size=512),
+            wbf_n_jobs=1,
+            postprocess="wbf",
+            inference_num_workers=0,
             model_architecture='tf_efficientnetv2_l',
     ):
         super().__init__()
@@ -57,27 +91,50 @@ class EfficientDetModel(LightningModule):
         self.prediction_confidence_threshold = prediction_confidence_threshold
         self.lr = learning_rate
         self.wbf_iou_threshold = wbf_iou_threshold
-        self.inference_tfms = inference_transforms
+        self.wbf_n_jobs = wbf_n_jobs
+        if postprocess not in ("wbf", "wbf_numba", "nms", "rtree_nms"):
+            raise ValueError(f"postprocess must be 'wbf', 'wbf_numba', 'nms' or 'rtree_nms', got {postprocess}")
+        self.postprocess = postprocess
+        self.inference_num_workers = inference_num_workers
+        # predict(images: List)의 GPU 전처리 (albumentations의 get_valid_transforms와 동일)
+        self.inference_resize = K.Resize((img_size, img_size), align_corners=False)
+        self.inference_normalize = K.Normalize(mean=torch.tensor(IMG_MEAN), std=torch.tensor(IMG_STD))
+
+        # to_tensorrt()가 채운다. None이면 eager pytorch로 inference
+        self.trt_engine = None
+        self.trt_context = None
+        self.trt_max_batch = 0
+        self._trt_buffers = {}
+        self._trt_tensor_names = []
 
     def forward(self, images, targets):
         return self.model(images, targets)
 
     def configure_optimizers(self):
-        return torch.optim.AdamW(self.model.parameters(), lr=self.lr)
+        params = list(self.model.parameters())
+        # fused(하나의 cuda kernel) -> foreach -> 기본 순으로, 설치된 pytorch가 지원하는 구현 사용
+        candidates = [{"fused": True}, {"foreach": True}, {}] if self.device.type == "cuda" else [{"foreach": True}, {}]
+        for kwargs in candidates:
+            try:
+                return torch.optim.AdamW(params, lr=self.lr, **kwargs)
+            except TypeError:
+                continue
 
     def training_step(self, batch, batch_idx):
         images, annotations, _, image_ids = batch
 
         losses = self.model(images, annotations)
 
-        # logging_losses = {
-        #     "class_loss": losses["class_loss"].detach(),
-        #     "box_loss": losses["box_loss"].detach(),
-        # }
+        logging_losses = {
+            "loss": losses["loss"].detach(),
+            "class_loss": losses["class_loss"].detach(),
+            "box_loss": losses["box_loss"].detach(),
+        }
 
-        self.log("train_loss", losses["loss"],              on_step=True, on_epoch=True, prog_bar=True, logger=True)
-        self.log("train_class_loss", losses["class_loss"],  on_step=True, on_epoch=True, prog_bar=True, logger=True)
-        self.log("train_box_loss", losses["box_loss"],      on_step=True, on_epoch=True, prog_bar=True, logger=True)
+        # step 단위 logging은 loss만. class/box loss는 epoch 단위로 GPU에서 누적
+        self.log("train_loss", logging_losses["loss"],              on_step=True, on_epoch=True, prog_bar=True, logger=True)
+        self.log("train_class_loss", logging_losses["class_loss"],  on_step=False, on_epoch=True, prog_bar=True, logger=True)
+        self.log("train_box_loss", logging_losses["box_loss"],      on_step=False, on_epoch=True, prog_bar=True, logger=True)
 
         return losses['loss']
 
@@ -90,24 +147,20 @@ class EfficientDetModel(LightningModule):
         outputs = self.model(images, annotations)
         # outputs.keys() = [detections, loss, class_loss, box_loss]
 
-        detections = outputs["detections"]
-
-        batch_predictions = {
-            "predictions": detections,
-            "targets": targets,
-            "image_ids": image_ids,
-        }
+        # post process(WBF)는 worker thread에서 수행. 다음 batch의 forward와 겹쳐서 실행된다.
+        self._val_queue.put((outputs["detections"].detach().cpu(), targets, image_ids))
 
         logging_losses = {
+            "loss": outputs["loss"].detach(),
             "class_loss": outputs["class_loss"].detach(),
             "box_loss": outputs["box_loss"].detach(),
         }
 
-        self.log("valid_loss", outputs["loss"],                     on_step=True, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
-        self.log("valid_class_loss", logging_losses["class_loss"],  on_step=True, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
-        self.log("valid_box_loss", logging_losses["box_loss"],      on_step=True, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
+        self.log("valid_loss", logging_losses["loss"],              on_step=False, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
+        self.log("valid_class_loss", logging_losses["class_loss"],  on_step=False, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
+        self.log("valid_box_loss", logging_losses["box_loss"],      on_step=False, on_epoch=True, prog_bar=True, logger=True, sync_dist=True)
 
-        return {'loss': outputs["loss"], 'batch_predictions': batch_predictions}
+        return {'loss': outputs["loss"]}
 
     @typedispatch
     def predict(self, images: List):
@@ -116,23 +169,39 @@ class EfficientDetModel(LightningModule):
         Args:
             images: a list of PIL images
 
-        Returns: a tuple of lists containing bboxes, predicted_class_labels, predicted_class_confidences
+        Returns: a tuple of lists containing bboxes, predicted_class_labels, predicted_class_confidences,
+            one entry per image: bboxes [[x1, y1, x2, y2], ...] in original image pixels, labels [float, ...],
+            confidences [float, ...]
 
         """
         image_sizes = [(image.size[1], image.size[0]) for image in images]
-        images_tensor = torch.stack(
-            [
-                self.inference_tfms(
-                    image=np.array(image, dtype=np.float32),
-                    labels=np.ones(1),
-                    bboxes=np.array([[0, 0, 1, 1]]),
-                )["image"]
-                for image in images
-            ]
-        )
+        images_tensor = self._images_to_tensor(images)
 
         return self._run_inference(images_tensor, image_sizes)
 
+    def _images_to_tensor(self, images: List) -> torch.Tensor:
+        """
+        PIL image들을 pinned uint8 tensor로 읽어 GPU로 올린 후
+        resize, normalize를 GPU에서 batch로 수행한다.
+
+        :param images: a list of PIL images
+        :return: N 3 img_size img_size
+        """
+        loader = DataLoader(
+            PILDataset(images),
+            batch_size=None,        # image 크기가 제각각이라 batch로 묶지 않음
+            num_workers=self.inference_num_workers,    # 기본 0: 호출마다 worker process를 띄우지 않음
+            pin_memory=self.device.type == "cuda",
+        )
+
+        # resize는 image 크기가 달라 image 별로, normalize는 batch 전체에 한번
+        resized = []
+        for image in loader:
+            x = image.to(self.device, non_blocking=True).permute(2, 0, 1).unsqueeze(0).float().div_(255)
+            resized.append(self.inference_resize(x))
+
+        return self.inference_normalize(torch.cat(resized))
+
     @typedispatch
     def predict(self, images_tensor: torch.Tensor):
         """
@@ -140,7 +209,9 @@ class EfficientDetModel(LightningModule):
         Args:
             images_tensor: the images tensor returned from the dataloader
 
-        Returns: a tuple of lists containing bboxes, predicted_class_labels, predicted_class_confidences
+        Returns: a tuple of lists containing bboxes, predicted_class_labels, predicted_class_confidences,
+            one entry per image: bboxes [[x1, y1, x2, y2], ...] in original image pixels, labels [float, ...],
+            confidences [float, ...]
 
         """
         if images_tensor.ndim == 3:
@@ -154,10 +225,126 @@ class EfficientDetModel(LightningModule):
 
         return self._run_inference(images_tensor, image_sizes)
 
+    def to_tensorrt(self, onnx_path="effdet.onnx", max_batch=8, workspace=4 << 30, fp16=True, opset_version=17):
+        """
+        self.model.model(EfficientDet)을 onnx로 export하고 TensorRT engine을 build한다.
+        loss 계산이 들어있는 DetBenchTrain은 export하지 않고, class_out/box_out 이후의
+        _post_process, _batch_detection은 기존처럼 pytorch에서 수행한다.
+        build 이후 _run_inference는 engine을 사용한다.
+
+        :param onnx_path: export할 onnx 파일
+        :param max_batch: optimization profile의 최대 batch size
+        :param workspace: builder workspace (bytes)
+        :param fp16: FP16 kernel 사용 여부
+        :param opset_version: onnx opset
+        """
+        import tensorrt as trt
+
+        net = self.model.model
+        was_training = net.training
+        num_levels = self.model.num_levels
+        output_names = [f"class_out_{i}" for i in range(num_levels)] + [f"box_out_{i}" for i in range(num_levels)]
+
+        dummy_images = torch.randn(1, 3, self.img_size, self.img_size, device=self.device)
+        # eval mode로 export하고 원래 mode로 복원
+        net.eval()
+        try:
+            torch.onnx.export(
+                net,
+                dummy_images,
+                onnx_path,
+                input_names=["images"],
+                output_names=output_names,
+                dynamic_axes={name: {0: "N"} for name in ["images"] + output_names},
+                opset_version=opset_version,
+            )
+        finally:
+            net.train(was_training)
+
+        logger = trt.Logger(trt.Logger.WARNING)
+        builder = trt.Builder(logger)
+        network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        parser = trt.OnnxParser(network, logger)
+        if not parser.parse_from_file(onnx_path):
+            errors = [str(parser.get_error(idx)) for idx in range(parser.num_errors)]
+            raise RuntimeError("failed to parse {}: {}".format(onnx_path, errors))
+
+        config = builder.create_builder_config()
+        config.set_memory_pool_limit(trt.MemoryPoolType.WORKSPACE, workspace)
+        if fp16 and builder.platform_has_fast_fp16:
+            config.set_flag(trt.BuilderFlag.FP16)
+
+        image_shape = (3, self.img_size, self.img_size)
+        profile = builder.create_optimization_profile()
+        profile.set_shape("images", (1, *image_shape), (max_batch, *image_shape), (max_batch, *image_shape))
+        config.add_optimization_profile(profile)
+
+        serialized_engine = builder.build_serialized_network(network, config)
+        if serialized_engine is None:
+            raise RuntimeError("failed to build tensorrt engine")
+
+        engine = trt.Runtime(logger).deserialize_cuda_engine(serialized_engine)
+        context = engine.create_execution_context()
+
+        # max_batch 크기로 device buffer를 한번만 할당하고, 호출마다 [:N] slice를 사용
+        # binding index API는 TensorRT 10에서 제거되어 tensor 이름 기반 API(8.5+)를 사용
+        context.set_input_shape("images", (max_batch, *image_shape))
+        tensor_names = [engine.get_tensor_name(idx) for idx in range(engine.num_io_tensors)]
+        buffers = {}
+        for name in tensor_names:
+            buffers[name] = torch.empty(
+                tuple(context.get_tensor_shape(name)),
+                dtype=torch.float32,
+                device=self.device,
+            )
+
+        self.trt_engine = engine
+        self.trt_context = context
+        self.trt_max_batch = max_batch
+        self._trt_buffers = buffers
+        self._trt_tensor_names = tensor_names
+
+        return engine
+
+    def _run_tensorrt(self, images_tensor: torch.Tensor, img_scale: torch.Tensor, img_size: torch.Tensor):
+        num_images = images_tensor.shape[0]
+        if num_images > self.trt_max_batch:
+            raise ValueError(f"batch size {num_images} exceeds tensorrt max_batch {self.trt_max_batch}")
+
+        buffers = {name: buffer[:num_images] for name, buffer in self._trt_buffers.items()}
+        buffers["images"].copy_(images_tensor, non_blocking=True)
+        self.trt_context.set_input_shape("images", tuple(buffers["images"].shape))
+
+        # 같은 torch stream 위에서 실행하므로 copy_ 및 이후 post process와 순서가 보장된다.
+        stream = torch.cuda.current_stream(self.device)
+        for name in self._trt_tensor_names:
+            self.trt_context.set_tensor_address(name, buffers[name].data_ptr())
+        self.trt_context.execute_async_v3(stream.cuda_stream)
+
+        num_levels = self.model.num_levels
+        class_out = [buffers[f"class_out_{i}"] for i in range(num_levels)]
+        box_out = [buffers[f"box_out_{i}"] for i in range(num_levels)]
+
+        class_out_pp, box_out_pp, indices, classes = _post_process(
+            class_out, box_out,
+            num_levels=num_levels,
+            num_classes=self.model.num_classes,
+            max_detection_points=self.model.max_detection_points)
+        return _batch_detection(
+            num_images, class_out_pp, box_out_pp, self.model.anchors.boxes, indices, classes,
+            img_scale, img_size,
+            max_det_per_image=self.model.max_det_per_image,
+            soft_nms=self.model.soft_nms)
+
     def _run_inference(self, images_tensor: torch.Tensor, image_sizes: List[Tuple[int, int]]):
         dummy_targets = self._create_dummy_inference_targets(num_images=images_tensor.shape[0])
 
-        detections = self.model(images_tensor.to(self.device), dummy_targets)["detections"]
+        if self.trt_context is not None:
+            detections = self._run_tensorrt(
+                images_tensor.to(self.device), dummy_targets["img_scale"], dummy_targets["img_size"]
+            )
+        else:
+            detections = self.model(images_tensor.to(self.device), dummy_targets)["detections"]
         # torch.Tensor
         # 0:4   boxes
         # 4     scores
@@ -165,121 +352,210 @@ class EfficientDetModel(LightningModule):
 
         predicted_bboxes, predicted_class_confidences, predicted_class_labels = self.post_process_detections(detections)
         scaled_bboxes = self.__rescale_bboxes(predicted_bboxes=predicted_bboxes, image_sizes=image_sizes)
-        return scaled_bboxes, predicted_class_labels, predicted_class_confidences
 
-    def _create_dummy_inference_targets(self, num_images):
-        dummy_targets = {
-            "bbox": [
-                torch.tensor([[0.0, 0.0, 0.0, 0.0]], device=self.device)
-                for i in range(num_images)
-            ],
-            "cls": [torch.tensor([1.0], device=self.device) for i in range(num_images)],
-            "img_size": torch.tensor(
-                [(self.img_size, self.img_size)] * num_images, device=self.device
-            ).float(),
-            "img_scale": torch.ones(num_images, device=self.device).float(),
-        }
+        # public 반환 형식은 list 유지 (내부는 image 별 numpy array)
+        return (
+            [bboxes.tolist() for bboxes in scaled_bboxes],
+            [labels.tolist() for labels in predicted_class_labels],
+            [confidences.tolist() for confidences in predicted_class_confidences],
+        )
 
-        return dummy_targets
+    def _create_dummy_inference_targets(self, num_images):
+        return _dummy_inference_targets(num_images, self.img_size, self.device)
 
     def post_process_detections(self, detections):
+        if self.postprocess == "nms":
+            return self._post_process_detections_nms(detections)
+        if self.postprocess == "rtree_nms":
+            return self._post_process_detections_rtree_nms(detections)
+        if self.postprocess == "wbf_numba":
+            from src.effdet_wbf import run_wbf_numba   # numba는 이 경우에만 필요
+
+            return run_wbf_numba(
+                detections.detach().cpu().numpy(),
+                image_size=self.img_size,
+                confidence_thr=self.prediction_confidence_threshold,
+                iou_thr=self.wbf_iou_threshold,
+            )
+
+        # batch 전체를 한번에 cpu로 복사 (image 별 sync 없음)
+        det_cpu = detections.detach().cpu()
         predictions = []
-        for i in range(detections.shape[0]):
+        for i in range(det_cpu.size(0)):
             predictions.append(
-                self._postprocess_single_prediction_detections(detections[i])
+                self._postprocess_single_prediction_detections(det_cpu[i])
             )
 
         predicted_bboxes, predicted_class_confidences, predicted_class_labels = run_wbf(
-            predictions, image_size=self.img_size, iou_thr=self.wbf_iou_threshold
+            predictions, image_size=self.img_size, iou_thr=self.wbf_iou_threshold, n_jobs=self.wbf_n_jobs
         )
 
         return predicted_bboxes, predicted_class_confidences, predicted_class_labels
 
+    def _post_process_detections_nms(self, detections):
+        """
+        WBF 대신 batch 전체를 GPU에서 한번의 batched_nms로 처리한다.
+        confidence threshold와 nms를 device에서 수행하고 남은 box만 cpu로 복사한다.
+
+        :param detections: N K 6 (x1, y1, x2, y2, score, class)
+        :return: bboxes, confidences, class_labels (image 별 numpy array의 list)
+        """
+        num_images, num_detections, _ = detections.shape
+        detections = detections.detach().reshape(-1, 6)
+        batch_idx = torch.arange(num_images, device=detections.device).repeat_interleave(num_detections)
+
+        keep = detections[:, 4] > self.prediction_confidence_threshold
+        detections, batch_idx = detections[keep], batch_idx[keep]
+
+        # image, class 별로 nms (class는 1부터 시작)
+        idxs = batch_idx * (self.model.num_classes + 1) + detections[:, 5].long()
+        kept = batched_nms(detections[:, :4], detections[:, 4], idxs, iou_threshold=self.wbf_iou_threshold)
+        # batched_nms는 score 순으로 반환하므로 원래 순서(image 순, image 내 score 순)로 되돌림
+        kept, _ = torch.sort(kept)
+
+        counts = torch.bincount(batch_idx[kept], minlength=num_images).tolist()
+        detections = detections[kept].cpu().numpy()
+        split = np.split(detections, np.cumsum(counts)[:-1])
+
+        predicted_bboxes = [d[:, :4] for d in split]
+        predicted_class_confidences = [d[:, 4] for d in split]
+        predicted_class_labels = [d[:, 5] for d in split]
+        return predicted_bboxes, predicted_class_confidences, predicted_class_labels
+
+    def _post_process_detections_rtree_nms(self, detections):
+        """
+        WBF 대신 powerboxes.rtree_nms(R-tree 기반 nms)를 image 별로 수행한다.
+        class 별 nms가 되도록 box를 class * (img_size + 1)만큼 이동시켜 한번에 호출한다.
+
+        :param detections: N K 6 (x1, y1, x2, y2, score, class)
+        :return: bboxes, confidences, class_labels (image 별 numpy array의 list)
+        """
+        import powerboxes
+
+        det_cpu = detections.detach().cpu().numpy().astype(np.float64)
+
+        predicted_bboxes = []
+        predicted_class_confidences = []
+        predicted_class_labels = []
+        for d in det_cpu:
+            offset_boxes = d[:, :4] + d[:, 5:6] * (self.img_size + 1)
+            keep = powerboxes.rtree_nms(
+                offset_boxes,
+                d[:, 4],
+                iou_threshold=self.wbf_iou_threshold,
+                score_threshold=self.prediction_confidence_threshold,
+            ).astype(np.int64)
+            predicted_bboxes.append(d[keep, :4])
+            predicted_class_confidences.append(d[keep, 4])
+            predicted_class_labels.append(d[keep, 5])
+
+        return predicted_bboxes, predicted_class_confidences, predicted_class_labels
+
     def _postprocess_single_prediction_detections(self, detections):
         """
         하나의 torch.tensor를 boxes(column0~4), scores(column4), classes(column5)로 분리한다.
         self.prediction_confidence_threshold 보다 큰 경우만 추출
 
-        :param detections:
+        :param detections: cpu로 복사된 하나의 image detections (K 6)
         :return:
         """
 
-        boxes = detections.detach().cpu().numpy()[:, :4]
-        scores = detections.detach().cpu().numpy()[:, 4]
-        classes = detections.detach().cpu().numpy()[:, 5]
-        indexes = np.where(scores > self.prediction_confidence_threshold)[0]
-        boxes = boxes[indexes]
+        detections = detections.numpy()
+        detections = detections[detections[:, 4] > self.prediction_confidence_threshold]
 
-        return {"boxes": boxes, "scores": scores[indexes], "classes": classes[indexes]}
+        return {"boxes": detections[:, :4], "scores": detections[:, 4], "classes": detections[:, 5]}
 
     def __rescale_bboxes(self, predicted_bboxes, image_sizes):
-        scaled_bboxes = []
-        for bboxes, img_dims in zip(predicted_bboxes, image_sizes):
-            im_h, im_w = img_dims
-
-            if len(bboxes) > 0:
-                scaled_bboxes.append(
-                    (
-                            np.array(bboxes)
-                            * [
-                                im_w / self.img_size,
-                                im_h / self.img_size,
-                                im_w / self.img_size,
-                                im_h / self.img_size,
-                            ]
-                    ).tolist()
-                )
-            else:
-                scaled_bboxes.append(bboxes)
-
-        return scaled_bboxes
-
-    def aggregate_prediction_outputs(self, outputs):
-        detections = torch.cat(
-            [output["batch_predictions"]["predictions"] for output in outputs]
-        )
-
-        image_ids = []
-        targets = []
-        for output in outputs:
-            batch_predictions = output["batch_predictions"]
-            image_ids.extend(batch_predictions["image_ids"])
-            targets.extend(batch_predictions["targets"])
+        """
+        img_size 기준의 box를 원본 image 크기로 scale한다.
+        전체 box 개수만큼 float32 buffer를 한번만 할당하고, image 별 slice에 scale한 값을 바로 쓴 후
+        buffer의 view로 나눠 반환한다.
 
-        (
-            predicted_bboxes,
-            predicted_class_confidences,
-            predicted_class_labels,
-        ) = self.post_process_detections(detections)
+        :return: image 별 (n, 4) numpy array(같은 buffer의 view)의 list
+        """
+        if len(predicted_bboxes) == 0:
+            return []
+
+        counts = np.array([len(bboxes) for bboxes in predicted_bboxes])
+        offsets = np.cumsum(counts)
+        out = np.empty((offsets[-1], 4), dtype=np.float32)
+
+        # image 별 [w/s, h/s, w/s, h/s]
+        inv = 1.0 / self.img_size
+        image_hw = np.asarray(image_sizes, dtype=np.float32)
+        image_hw *= inv
+        scales_per_image = image_hw[:, [1, 0, 1, 0]]
+
+        for bboxes, scale, end, n in zip(predicted_bboxes, scales_per_image, offsets, counts):
+            if n > 0:
+                np.multiply(bboxes, scale, out=out[end - n:end], casting="unsafe")
+
+        return np.split(out, offsets[:-1])
+
+    def on_validation_epoch_start(self):
+        self._val_queue = queue.Queue()
+        self._val_results = {
+            "image_ids": [],
+            "bboxes": [],
+            "confidences": [],
+            "labels": [],
+            "truth_image_ids": [],
+            "truth_boxes": [],
+            "truth_labels": [],
+        }
+        self._val_error = None
+        self._val_worker = threading.Thread(target=self._validation_worker, daemon=True)
+        self._val_worker.start()
 
-        return (
-            predicted_class_labels,
-            image_ids,
-            predicted_bboxes,
-            predicted_class_confidences,
-            targets,
-        )
+    def _validation_worker(self):
+        """
+        validation_step이 넣은 (detections, targets, image_ids)를 꺼내 post process하고 결과를 누적한다.
+        None을 받으면 종료한다.
+        """
+        results = self._val_results
+        while True:
+            item = self._val_queue.get()
+            if item is None:
+                return
+            if self._val_error is not None:
+                continue
+
+            try:
+                detections, targets, image_ids = item
+                predicted_bboxes, predicted_class_confidences, predicted_class_labels = \
+                    self.post_process_detections(detections)
+
+                results["image_ids"].extend(image_ids)
+                results["bboxes"].extend(bboxes.tolist() for bboxes in predicted_bboxes)
+                results["confidences"].extend(confidences.tolist() for confidences in predicted_class_confidences)
+                results["labels"].extend(labels.tolist() for labels in predicted_class_labels)
+
+                results["truth_image_ids"].extend(target["image_id"].detach().item() for target in targets)
+                # convert to xyxy for evaluation
+                results["truth_boxes"].extend(target["bboxes"].detach()[:, [1, 0, 3, 2]].tolist() for target in targets)
+                results["truth_labels"].extend(target["labels"].detach().tolist() for target in targets)
+            except Exception as e:
+                self._val_error = e
 
     def validation_epoch_end(self, outputs):
         """Compute and log training loss and accuracy at the epoch level."""
 
-        (predicted_class_labels, image_ids, predicted_bboxes, predicted_class_confidences, targets,) = self.aggregate_prediction_outputs(outputs)
-
-        truth_image_ids = [target["image_id"].detach().item() for target in targets]
-        # convert to xyxy for evaluation
-        truth_boxes = [target["bboxes"].detach()[:, [1, 0, 3, 2]].tolist() for target in targets]
-        truth_labels = [target["labels"].detach().tolist() for target in targets]
+        self._val_queue.put(None)
+        self._val_worker.join()
+        if self._val_error is not None:
+            raise self._val_error
 
+        results = self._val_results
         return {
             "val_loss": torch.stack([output["loss"] for output in outputs]).mean(),
             "metrics": get_coco_stats(
-                prediction_image_ids=image_ids,
-                predicted_class_confidences=predicted_class_confidences,
-                predicted_bboxes=predicted_bboxes,
-                predicted_class_labels=predicted_class_labels,
-
-                target_image_ids=truth_image_ids,
-                target_bboxes=truth_boxes,
-                target_class_labels=truth_labels,
+                prediction_image_ids=results["image_ids"],
+                predicted_class_confidences=results["confidences"],
+                predicted_bboxes=results["bboxes"],
+                predicted_class_labels=results["labels"],
+
+                target_image_ids=results["truth_image_ids"],
+                target_bboxes=results["truth_boxes"],
+                target_class_labels=results["truth_labels"],
             )['All']
         }
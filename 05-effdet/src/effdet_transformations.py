@@ -1,13 +1,16 @@
 import albumentations as A
 from albumentations.pytorch.transforms import ToTensorV2
 
+IMG_MEAN = [0.485, 0.456, 0.406]
+IMG_STD = [0.229, 0.224, 0.225]
+
 
 def get_train_transforms(target_img_size=512):
     return A.Compose(
         [
             A.HorizontalFlip(p=0.5),
             A.Resize(height=target_img_size, width=target_img_size, p=1),
-            A.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            A.Normalize(IMG_MEAN, IMG_STD),
             ToTensorV2(p=1),
         ],
         p=1.0,
@@ -21,7 +24,7 @@ def get_valid_transforms(target_img_size=512):
     return A.Compose(
         [
             A.Resize(height=target_img_size, width=target_img_size, p=1),
-            A.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            A.Normalize(IMG_MEAN, IMG_STD),
             ToTensorV2(p=1),
         ],
         p=1.0,
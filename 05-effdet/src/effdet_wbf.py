@@ -0,0 +1,140 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True)
+def _iou(a, b):
+    x1 = max(a[0], b[0])
+    y1 = max(a[1], b[1])
+    x2 = min(a[2], b[2])
+    y2 = min(a[3], b[3])
+    inter = max(x2 - x1, 0.0) * max(y2 - y1, 0.0)
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return inter / (area_a + area_b - inter)
+
+
+@njit(parallel=True, cache=True)
+def _threshold_boxes(detections, thr):
+    """
+    detections(N K 6)에서 score(column4)가 thr보다 큰 row의 mask와 image 별 개수
+    """
+    n, k, _ = detections.shape
+    keep = np.zeros((n, k), dtype=np.bool_)
+    counts = np.zeros(n, dtype=np.int64)
+    for i in prange(n):
+        for j in range(k):
+            if detections[i, j, 4] > thr:
+                keep[i, j] = True
+                counts[i] += 1
+    return keep, counts
+
+
+@njit(cache=True)
+def _wbf_kernel(boxes, scores, labels, iou_thr, skip_thr):
+    """
+    ensemble_boxes_wbf.weighted_boxes_fusion을 model 1개, weights=None, conf_type='avg'로
+    호출한 것과 같은 결과를 낸다.
+
+    :param boxes: n 4, [0, 1]로 normalize된 x1 y1 x2 y2
+    :return: boxes, scores, labels (score 내림차순)
+    """
+    n = boxes.shape[0]
+
+    # prefilter: skip_thr 미만 제거, [0, 1]로 clip, 좌표 swap, 면적 0 제거
+    clipped = np.empty((n, 4), dtype=np.float64)
+    valid = np.zeros(n, dtype=np.bool_)
+    for j in range(n):
+        if scores[j] < skip_thr:
+            continue
+        x1 = min(max(boxes[j, 0], 0.0), 1.0)
+        y1 = min(max(boxes[j, 1], 0.0), 1.0)
+        x2 = min(max(boxes[j, 2], 0.0), 1.0)
+        y2 = min(max(boxes[j, 3], 0.0), 1.0)
+        if x2 < x1:
+            x1, x2 = x2, x1
+        if y2 < y1:
+            y1, y2 = y2, y1
+        if (x2 - x1) * (y2 - y1) == 0.0:
+            continue
+        clipped[j, 0] = x1
+        clipped[j, 1] = y1
+        clipped[j, 2] = x2
+        clipped[j, 3] = y2
+        valid[j] = True
+
+    candidates = np.where(valid)[0]
+    order = candidates[np.argsort(-scores[candidates], kind="mergesort")]
+
+    # cluster 별 score 가중합, score 합, box 개수
+    box_sum = np.zeros((n, 4), dtype=np.float64)
+    fused = np.zeros((n, 4), dtype=np.float64)
+    conf_sum = np.zeros(n, dtype=np.float64)
+    count = np.zeros(n, dtype=np.int64)
+    cluster_labels = np.zeros(n, dtype=np.float64)
+    m = 0
+
+    for j in order:
+        best = -1
+        best_iou = iou_thr
+        for c in range(m):
+            if cluster_labels[c] != labels[j]:
+                continue
+            iou = _iou(fused[c], clipped[j])
+            if iou > best_iou:
+                best_iou = iou
+                best = c
+
+        if best == -1:
+            best = m
+            cluster_labels[best] = labels[j]
+            m += 1
+
+        score = scores[j]
+        for col in range(4):
+            box_sum[best, col] += score * clipped[j, col]
+        conf_sum[best] += score
+        count[best] += 1
+        for col in range(4):
+            fused[best, col] = box_sum[best, col] / conf_sum[best]
+
+    out_scores = conf_sum[:m] / count[:m]
+    result_order = np.argsort(-out_scores, kind="mergesort")
+    return fused[:m][result_order], out_scores[result_order], cluster_labels[:m][result_order]
+
+
+@njit(parallel=True, cache=True)
+def _wbf_batch(detections, image_size, confidence_thr, iou_thr, skip_thr):
+    n, k, _ = detections.shape
+    keep, _ = _threshold_boxes(detections, confidence_thr)
+
+    out = np.zeros((n, k, 6), dtype=np.float64)
+    counts = np.zeros(n, dtype=np.int64)
+    for i in prange(n):
+        selected = detections[i][keep[i]]
+        boxes, scores, labels = _wbf_kernel(
+            selected[:, :4] / image_size, selected[:, 4], selected[:, 5], iou_thr, skip_thr
+        )
+        m = boxes.shape[0]
+        out[i, :m, :4] = boxes * (image_size - 1)
+        out[i, :m, 4] = scores
+        out[i, :m, 5] = labels
+        counts[i] = m
+    return out, counts
+
+
+def run_wbf_numba(detections, image_size=512, confidence_thr=0.2, iou_thr=0.44, skip_box_thr=0.43):
+    """
+    confidence threshold와 WBF를 numba로 image 병렬 처리한다. run_wbf와 같은 형식을 반환.
+
+    :param detections: N K 6 numpy array (x1, y1, x2, y2, score, class)
+    :return: bboxes, confidences, class_labels (image 별 numpy array의 list)
+    """
+    out, counts = _wbf_batch(
+        np.ascontiguousarray(detections, dtype=np.float64), float(image_size),
+        confidence_thr, iou_thr, skip_box_thr,
+    )
+    predicted_bboxes = [out[i, :m, :4] for i, m in enumerate(counts)]
+    predicted_class_confidences = [out[i, :m, 4] for i, m in enumerate(counts)]
+    predicted_class_labels = [out[i, :m, 5] for i, m in enumerate(counts)]
+    return predicted_bboxes, predicted_class_confidences, predicted_class_labels
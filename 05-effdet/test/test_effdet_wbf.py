@@ -0,0 +1,40 @@
+import numpy as np
+from ensemble_boxes import ensemble_boxes_wbf
+
+from src.effdet_wbf import _wbf_kernel, run_wbf_numba
+
+
+def _random_detections(rng, num_boxes, image_size=512):
+    xy = rng.uniform(0, image_size * 0.8, size=(num_boxes, 2))
+    wh = rng.uniform(10, image_size * 0.2, size=(num_boxes, 2))
+    scores = rng.uniform(0, 1, size=(num_boxes, 1))
+    classes = rng.integers(1, 3, size=(num_boxes, 1)).astype(np.float64)
+    return np.hstack([xy, xy + wh, scores, classes])
+
+
+def test_wbf_kernel_same_as_ensemble_boxes():
+    rng = np.random.default_rng(0)
+    detections = _random_detections(rng, 100)
+    boxes = detections[:, :4] / 512
+
+    expected_boxes, expected_scores, expected_labels = ensemble_boxes_wbf.weighted_boxes_fusion(
+        [boxes], [detections[:, 4]], [detections[:, 5]], iou_thr=0.44, skip_box_thr=0.43,
+    )
+    fused_boxes, fused_scores, fused_labels = _wbf_kernel(boxes, detections[:, 4], detections[:, 5], 0.44, 0.43)
+
+    np.testing.assert_allclose(fused_boxes, expected_boxes, atol=1e-6)
+    np.testing.assert_allclose(fused_scores, expected_scores, atol=1e-6)
+    np.testing.assert_array_equal(fused_labels, expected_labels)
+
+
+def test_run_wbf_numba_empty_image():
+    rng = np.random.default_rng(1)
+    detections = np.stack([_random_detections(rng, 100), np.zeros((100, 6))])
+
+    bboxes, confidences, labels = run_wbf_numba(detections, image_size=512)
+
+    assert len(bboxes) == 2
+    assert bboxes[0].shape[1] == 4
+    assert bboxes[1].shape == (0, 4)
+    assert confidences[1].shape == (0,)
+    assert labels[1].shape == (0,)
@@ -64,6 +64,8 @@ def train(resume_model_path=None):
         gpus=[0],
         #gpus=None,
         max_epochs=30,
+        precision=16,       # native AMP, optimizer state는 FP32로 유지됨. Ampere+에서는 'bf16'
+        benchmark=True,
         num_sanity_val_steps=1,
     )
 
@@ -1,27 +1,31 @@
 import torch
-from torch.autograd import Variable
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
 
 # N is batch size; D_in is input dimension;
 # H is hidden dimension; D_out is output dimension.
 N, D_in, H, D_out = 64, 1000, 100, 10
-x = Variable(torch.randn(N, D_in), requires_grad=False)
-y = Variable(torch.randn(N, D_out), requires_grad=False)
+x = torch.randn(N, D_in, device=device)
+y = torch.randn(N, D_out, device=device)
 
 model = torch.nn.Sequential(
     torch.nn.Linear(D_in, H),
     torch.nn.ReLU(),
     torch.nn.Linear(H, D_out),
-)
-loss_fn = torch.nn.MSELoss(size_average=False)
+).to(device)
+# Inductor graph fusion; reduce-overhead also captures CUDA graphs
+model = torch.compile(model, mode='reduce-overhead')
+loss_fn = torch.nn.MSELoss(reduction='sum')
 
 learning_rate = 1e-4
-optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+# fused: 모든 parameter를 하나의 cuda kernel로 update
+optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, fused=device == "cuda")
 
 for t in range(500):
     y_pred = model(x)
     loss = loss_fn(y_pred, y)
 
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
     loss.backward()
 
     optimizer.step()